@@ -13,37 +13,89 @@ dataset for training.
 """
 
 import os
-import hashlib
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
+import httpx
 import streamlit as st
 import streamlit_authenticator as stauth
-from openai import OpenAI
+from openai import DefaultHttpxClient, OpenAI
 
-from auth_db import init_db, add_user, save_msg, load_history, get_users
+from auth_db import (
+    init_db,
+    add_user,
+    save_msgs,
+    load_history,
+    get_users,
+    users_version,
+    hash_password,
+    upgrade_legacy_password,
+)
 
-# Initialise the SQLite database.  This creates the necessary tables
-# on the first run.  If the database file resides on a persistent
-# volume (e.g. Render's Disk), chat history and user accounts will
-# survive across deployments.
+# Initialise the database.  This creates the necessary tables on the
+# first run and is a no‑op on later reruns in the same process.  If the
+# database file resides on a persistent volume (e.g. Render's Disk),
+# chat history and user accounts will survive across deployments.
 init_db()
 
-# Build the credentials dictionary from the SQLite users table.  The
+# Build the credentials dictionary from the cached users table.  The
 # streamlit-authenticator package expects a nested dictionary of the form
 # {"usernames": {username: {"name": <display_name>, "email": <email>, "password": <password_hash>}}}
-def build_credentials():
-    creds = {"usernames": {}}
-    for uname, pwd_hash in get_users():
-        # For this simple application we use the username for both the
-        # display name and the email field.  If you wish to store
-        # additional metadata (e.g. proper name or email) you can do
-        # that in the database and populate it here.
-        creds["usernames"][uname] = {
-            "name": uname,
-            "email": f"{uname}@example.com",
-            "password": pwd_hash,
+# The result is cached per users version, so it is only rebuilt after a
+# new user registers.  ``st.cache_data`` hands out a fresh copy on each
+# call, which keeps the authenticator from mutating the cached value.
+@st.cache_data(show_spinner=False)
+def build_credentials(version):
+    # For this simple application we use the username for both the
+    # display name and the email field.  If you wish to store
+    # additional metadata (e.g. proper name or email) you can do
+    # that in the database and populate it here.
+    return {
+        "usernames": {
+            uname: {
+                "name": uname,
+                "email": f"{uname}@example.com",
+                "password": pwd_hash,
+            }
+            for uname, pwd_hash in get_users()
         }
-    return creds
+    }
+
+
+# The fine‑tuning code pulls in unsloth, torch and trl, which take a long
+# time to import and need a GPU.  Import it lazily on the first request
+# and keep it, together with a single‑worker executor, for the lifetime
+# of the server so that later jobs reuse the already loaded libraries.
+# One worker means fine‑tuning jobs run one at a time on the GPU.
+@st.cache_resource
+def get_finetune():
+    import finetune
+
+    return finetune
+
+
+@st.cache_resource
+def get_finetune_executor():
+    return ThreadPoolExecutor(max_workers=1)
+
+
+# The OpenAI client is created once per server process and shared by all
+# sessions.  Reusing it keeps the HTTP connection to the API alive
+# between chat turns instead of paying a new TLS handshake each time.
+# ``DefaultHttpxClient`` keeps the SDK's own defaults (timeouts,
+# redirects); the keep‑alive expiry is raised from httpx's 5 seconds so
+# the connection survives while the user types the next message.
+@st.cache_resource
+def get_client():
+    return OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=1000,
+                max_keepalive_connections=10,
+                keepalive_expiry=120,
+            )
+        ),
+    )
 
 
 # -----------------------------------------------------------------------------
@@ -51,24 +103,25 @@ def build_credentials():
 # -----------------------------------------------------------------------------
 
 # Streamlit‑authenticator maintains its own internal state in
-# `st.session_state.auth`.  The first time the app loads, we create
-# an authenticator instance with an empty credentials dictionary.
-# Later, when users register, their credentials will be stored in
-# SQLite, but for demonstration purposes we do not pre‑populate the
-# authenticator.
-if "auth" not in st.session_state:
-    # Build a fresh credentials dictionary from the database.  This ensures
-    # that any previously registered users are recognised by
-    # streamlit‑authenticator.  The credentials dictionary must be
-    # reconstructed at runtime because the authenticator stores it only in
-    # memory and does not persist it across reruns.
-    creds = build_credentials()
+# `st.session_state.auth`.  The authenticator is created with the
+# credentials currently stored in SQLite and is only rebuilt when the
+# users table changes, which `users_version()` tells us cheaply
+# without touching the database on every rerun.
+def build_authenticator():
+    # The credentials dictionary must be reconstructed at runtime
+    # because the authenticator stores it only in memory and does not
+    # persist it across reruns.
     st.session_state.auth = stauth.Authenticate(
-        credentials=creds,
+        credentials=build_credentials(users_version()),
         cookie_name="expert_tune",
         cookie_key="abc123",
         cookie_expiry_days=30.0,
     )
+    st.session_state._creds_version = users_version()
+
+
+if st.session_state.get("_creds_version") != users_version():
+    build_authenticator()
 
 # Render the login form in the sidebar.  The login call returns
 # three values: name (unused), auth_status (True/False/None) and
@@ -99,31 +152,103 @@ if st.session_state.register:
     new_pwd = st.sidebar.text_input("პაროლი", type="password", key="reg_pwd")
     if st.sidebar.button("დარეგისტრირდი", key="register_submit"):
         if new_user and new_pwd:
-            pwd_hash = hashlib.sha256(new_pwd.encode()).hexdigest()
-            # Persist the new user to the database
-            add_user(new_user, pwd_hash)
-            # Rebuild the authenticator with updated credentials.  The
-            # Authenticate object does not expose a public ``credentials``
-            # attribute in newer versions, so we cannot mutate it
-            # directly.  Instead, recreate the authenticator using the
-            # fresh credentials from the database.  This will also
-            # reset any login state, requiring the user to log in again.
-            new_creds = build_credentials()
-            st.session_state.auth = stauth.Authenticate(
-                credentials=new_creds,
-                cookie_name="expert_tune",
-                cookie_key="abc123",
-                cookie_expiry_days=30.0,
-            )
-            st.sidebar.success("დარეგისტრირდით! გაიარეთ ლოგინი.")
-            # Reset registration state after success
-            st.session_state.register = False
-            st.session_state.reg_user = ""
-            st.session_state.reg_pwd = ""
+            pwd_hash = hash_password(new_pwd)
+            # Persist the new user to the database.  If the username is
+            # taken by an account with a legacy SHA256 hash of the same
+            # password, upgrade that account to bcrypt instead.
+            if add_user(new_user, pwd_hash) or upgrade_legacy_password(
+                new_user, new_pwd
+            ):
+                # Rebuild the authenticator with updated credentials.  The
+                # Authenticate object does not expose a public ``credentials``
+                # attribute in newer versions, so we cannot mutate it
+                # directly.  Instead, recreate the authenticator using the
+                # fresh credentials.  This will also reset any login state,
+                # requiring the user to log in again.
+                build_authenticator()
+                st.sidebar.success("დარეგისტრირდით! გაიარეთ ლოგინი.")
+                # Reset registration state after success
+                st.session_state.register = False
+                st.session_state.reg_user = ""
+                st.session_state.reg_pwd = ""
+            else:
+                st.sidebar.warning("ეს მომხმარებლის სახელი უკვე დაკავებულია.")
         else:
             st.sidebar.warning("გთხოვთ შეავსოთ ორივე ველი.")
 
 
+# The chat is rendered inside a fragment.  Submitting a message then
+# reruns only this function instead of the whole script, so the
+# authenticator, sidebar and database lookups above are skipped on
+# every chat turn.  Fragments cannot place widgets outside their own
+# container, so the chat input is rendered inline below the history.
+@st.experimental_fragment
+def render_chat(username, domain, key):
+    # Display the conversation so far.  New messages are added to the
+    # same container so that they appear above the input box.
+    history = st.container()
+    for msg in st.session_state[key]:
+        history.chat_message(msg["role"]).write(msg["content"])
+
+    # Chat input box.  When the user submits text, we append it to
+    # the in‑memory conversation and call OpenAI's API with a system
+    # prompt and the chat history.  The reply is streamed into the
+    # page as it arrives, and both turns are then persisted to the
+    # database in one transaction.
+    if prompt := st.container().chat_input():
+        # Append the user's message
+        st.session_state[key].append({"role": "user", "content": prompt})
+        history.chat_message("user").write(prompt)
+
+        # Compose a minimal system prompt.  The assistant is asked
+        # to pose seven concise questions about the selected domain.
+        system = f"You are a Georgian data‑collector for {domain}. Ask 7 concise questions."
+        messages = [{"role": "system", "content": system}] + st.session_state[key]
+
+        # Call the OpenAI API.  The API key must be provided via
+        # environment variable or .env file.  The model `gpt‑4o‑mini`
+        # provides good quality at a reasonable cost.
+        fallback = "სამწუხაროდ, AI‑თან დაკავშირება ვერ მოხერხდა."
+        parts = []
+        reply = None
+
+        def reply_tokens(stream):
+            # Keep the tokens received so far so that a partial reply
+            # can be saved if the stream is interrupted.
+            for chunk in stream:
+                if chunk.choices:
+                    text = chunk.choices[0].delta.content or ""
+                    parts.append(text)
+                    yield text
+
+        try:
+            try:
+                stream = get_client().chat.completions.create(
+                    model="gpt-4o-mini", messages=messages, stream=True
+                )
+                # ``write_stream`` renders tokens as they arrive and
+                # returns the concatenated text once the stream ends.
+                reply = history.chat_message("assistant").write_stream(
+                    reply_tokens(stream)
+                )
+            except Exception as exc:
+                # In case of an API error, log the error and inform the user
+                reply = fallback
+                history.error(f"OpenAI error: {exc}")
+                history.chat_message("assistant").write(reply)
+        finally:
+            # Streamlit stops a running script (e.g. when the user
+            # switches domain or sends another message mid‑stream) by
+            # raising an exception that is not an ``Exception``.  Persist
+            # both turns regardless, keeping whatever part of the reply
+            # arrived, so the database and session stay in user/assistant
+            # pairs.
+            if reply is None:
+                reply = "".join(parts) or fallback
+            st.session_state[key].append({"role": "assistant", "content": reply})
+            save_msgs(username, domain, [("user", prompt), ("assistant", reply)])
+
+
 # -----------------------------------------------------------------------------
 # 3. Main application logic
 # -----------------------------------------------------------------------------
@@ -145,60 +270,36 @@ if auth_status:
     # to have separate chat histories stored in session_state.
     key = f"msgs_{username}_{domain}"
     if key not in st.session_state:
-        # Load any existing history from the database into session
+        # Load any existing history from the database into session.
+        # This happens once per domain and session; switching back to
+        # a domain later is served from session_state.
         st.session_state[key] = load_history(username, domain)
 
-    # Display the conversation so far
-    for msg in st.session_state[key]:
-        st.chat_message(msg["role"]).write(msg["content"])
-
-    # Chat input box.  When the user submits text, we append it to
-    # the in‑memory conversation and persist it to the database.  We
-    # then call OpenAI's API with a system prompt and the chat
-    # history to get the assistant's next message.
-    if prompt := st.chat_input():
-        # Append the user's message
-        st.session_state[key].append({"role": "user", "content": prompt})
-        st.chat_message("user").write(prompt)
-        save_msg(username, domain, "user", prompt)
-
-        # Compose a minimal system prompt.  The assistant is asked
-        # to pose seven concise questions about the selected domain.
-        system = f"You are a Georgian data‑collector for {domain}. Ask 7 concise questions."
-        messages = [{"role": "system", "content": system}] + st.session_state[key]
-
-        # Call the OpenAI API.  The API key must be provided via
-        # environment variable or .env file.  The model `gpt‑4o‑mini`
-        # provides good quality at a reasonable cost.
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        try:
-            reply = client.chat.completions.create(
-                model="gpt-4o-mini", messages=messages
-            ).choices[0].message.content
-        except Exception as exc:
-            # In case of an API error, log the error and inform the user
-            reply = "სამწუხაროდ, AI‑თან დაკავშირება ვერ მოხერხდა."
-            st.error(f"OpenAI error: {exc}")
-
-        # Append assistant reply
-        st.session_state[key].append({"role": "assistant", "content": reply})
-        st.chat_message("assistant").write(reply)
-        save_msg(username, domain, "assistant", reply)
+    # Display the conversation and the chat input
+    render_chat(username, domain, key)
 
     # A button to trigger fine‑tuning.  We only enable the button
-    # when there is at least one message in the conversation.
+    # when there is at least one message in the conversation.  The
+    # job runs in a background thread so that the page stays
+    # responsive; its future is kept in session_state and its status
+    # is reported on subsequent reruns.  A new job is only submitted
+    # once the previous one has finished, so repeated clicks neither
+    # queue duplicate runs nor hide the first job's result.
+    job_key = f"finetune_{username}_{domain}"
+    job = st.session_state.get(job_key)
     if st.button("🚀 დაიწყე ფაინ-ტუნინგი") and st.session_state[key]:
-        st.info("ჩატის ისტორია შენახულია. ფაინ-ტუნინგი იწყება...")
-        # Prepare environment variables for the subprocess.  We
-        # propagate the current username and domain so that
-        # `finetune.py` knows which chat history to use.
-        env = os.environ.copy()
-        env["CURRENT_USER"] = username
-        env["CURRENT_DOMAIN"] = domain
-        # Launch the fine‑tuning script.  Any errors will bubble up
-        # and cause the page to display an exception.
-        subprocess.run(["python", "finetune.py"], env=env, check=True)
-        st.success("ფაინ-ტუნინგი დასრულდა! მოდელი შეგიძლიათ გამოიყენოთ.")
+        if job is None or job.done():
+            job = get_finetune_executor().submit(
+                get_finetune().main, user=username, domain=domain
+            )
+            st.session_state[job_key] = job
+    if job is not None:
+        if not job.done():
+            st.info("ჩატის ისტორია შენახულია. ფაინ-ტუნინგი მიმდინარეობს...")
+        elif job.exception() is not None:
+            st.error(f"ფაინ-ტუნინგი ვერ მოხერხდა: {job.exception()}")
+        else:
+            st.success("ფაინ-ტუნინგი დასრულდა! მოდელი შეგიძლიათ გამოიყენოთ.")
 
 elif auth_status is False:
     # Display a message when authentication fails
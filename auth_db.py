@@ -4,19 +4,41 @@ auth_db.py
 
 This module encapsulates all database interactions for the Expert‑Tune
 application.  It uses SQLite as a lightweight, file‑based database to
-store registered users and their chat histories.  Two tables are
+store registered users and their chat histories, or PostgreSQL when
+`DATABASE_URL` points to one.  Two tables are
 created on first run: one for user credentials and another for the
 chat transcripts.  Helper functions abstract away the SQL so that
-`app.py` can simply call `add_user`, `save_msg` and `load_history`.
+`app.py` can simply call `add_user`, `save_msg`, `save_msgs` and
+`load_history`.
 
 The database filename can be customised by setting the `DB` constant
 below.  When run on Render with a persistent disk, this file will
 reside on that volume, ensuring chat history and user accounts are
-preserved across deployments.
+preserved across deployments.  For multi‑user deployments set
+`DATABASE_URL` to a ``postgresql://`` URL instead; SQLite allows only
+one writer at a time, whereas PostgreSQL handles concurrent chat
+writes.  The PostgreSQL driver (``psycopg``) is only imported in that
+case.
+
+Queries run on a small pool of long‑lived connections.  Streamlit
+reruns the whole script on every interaction, so opening a fresh
+connection per query would pay the file‑open and journal setup cost
+on every keystroke, while a single shared connection would make
+concurrent sessions wait for each other.  The connections run in
+autocommit mode with the write‑ahead log enabled, so readers do not
+block one another and no explicit ``commit()`` is needed.
 """
 
+import atexit
+import contextlib
+import hashlib
+import hmac
+import queue
 import sqlite3
 import os
+import threading
+import time
+import bcrypt
 import streamlit as st
 
 # Name of the SQLite database file.  If you wish to store the
@@ -25,63 +47,310 @@ import streamlit as st
 # persistent disk.
 DB = os.getenv("DATABASE_FILE", "users.db")
 
+# Database URL.  ``sqlite:///<path>`` selects the SQLite backend and
+# ``postgresql://...`` the PostgreSQL one.  Defaults to the SQLite
+# file above.
+DB_URL = os.getenv("DATABASE_URL", f"sqlite:///{DB}")
+if DB_URL.startswith("sqlite:///"):
+    DB = DB_URL[len("sqlite:///"):]
+_POSTGRES = DB_URL.startswith(("postgres://", "postgresql://"))
+
+# Maximum number of pooled connections.  Connections are opened on
+# demand up to this limit; further callers wait for one to be returned.
+POOL_SIZE = 8
+
+# PRAGMAs applied once when each pooled connection is opened.  WAL lets
+# readers proceed while a write is in progress, and NORMAL
+# synchronisation is safe in WAL mode while avoiding an fsync per
+# statement.
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA mmap_size=268435456",
+)
+
+_pool = queue.LifoQueue()
+_pool_conns = []
+_pg_pool = None
+# In‑memory copy of the ``users`` table, mapping each username to its
+# password hash.  It is loaded on first use, kept in sync by `add_user`
+# and re‑read once it is older than ``USERS_CACHE_TTL`` seconds, so
+# users registered by another process (e.g. another app instance on
+# the same PostgreSQL database) show up without a restart.
+# ``_users_version`` is bumped whenever the set of users changes so
+# callers can tell when derived data (such as the authenticator
+# credentials) needs rebuilding.
+USERS_CACHE_TTL = 60
+_users_cache = None
+_users_loaded_at = 0.0
+_users_version = 0
+# Set once `init_db` has run in this process.
+_initialised = False
+# Streamlit serves each session from its own thread.  This lock guards
+# growing the pool and the users cache; queries themselves run
+# concurrently on separate connections.
+_lock = threading.RLock()
+
+
+def _open_conn() -> sqlite3.Connection:
+    """Open a new SQLite connection configured for pooled use."""
+    conn = sqlite3.connect(
+        DB,
+        check_same_thread=False,
+        isolation_level=None,
+        cached_statements=256,
+    )
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _postgres_pool():
+    """Return the PostgreSQL connection pool, creating it on first use."""
+    global _pg_pool
+    if _pg_pool is None:
+        with _lock:
+            if _pg_pool is None:
+                from psycopg_pool import ConnectionPool
+
+                _pg_pool = ConnectionPool(
+                    DB_URL,
+                    max_size=POOL_SIZE,
+                    kwargs={"autocommit": True},
+                    open=True,
+                )
+    return _pg_pool
+
+
+def _sql(query: str) -> str:
+    """Adapt a query written with ``?`` placeholders to the backend."""
+    return query.replace("?", "%s") if _POSTGRES else query
+
+
+# Queries on the hot path, built once so that every call passes the
+# same text and hits the connection's prepared statement cache.
+_SQL_INSERT_USER = _sql(
+    "INSERT INTO users (username, password_hash) VALUES (?, ?) "
+    "ON CONFLICT (username) DO NOTHING"
+)
+_SQL_INSERT_MSG = _sql(
+    "INSERT INTO chat_history(username, domain, role, content) VALUES (?, ?, ?, ?)"
+)
+_SQL_SELECT_HISTORY = _sql(
+    "SELECT role, content FROM chat_history WHERE username = ? AND domain = ? ORDER BY id"
+)
+_SQL_SELECT_USERS = "SELECT username, password_hash FROM users"
+_SQL_SELECT_USER_HASH = _sql("SELECT password_hash FROM users WHERE username = ?")
+_SQL_UPDATE_USER_HASH = _sql(
+    "UPDATE users SET password_hash = ? WHERE username = ? AND password_hash = ?"
+)
+
+
+@contextlib.contextmanager
+def _connection():
+    """Borrow a connection from the pool for the duration of a block."""
+    if _POSTGRES:
+        with _postgres_pool().connection() as conn:
+            yield conn
+        return
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = None
+        with _lock:
+            if len(_pool_conns) < POOL_SIZE:
+                conn = _open_conn()
+                _pool_conns.append(conn)
+        if conn is None:
+            conn = _pool.get()
+    try:
+        yield conn
+    finally:
+        _pool.put(conn)
+
+
+@atexit.register
+def _close_pool() -> None:
+    """Close all pooled connections when the interpreter exits."""
+    global _pg_pool
+    with _lock:
+        for conn in _pool_conns:
+            conn.close()
+        _pool_conns.clear()
+        if _pg_pool is not None:
+            _pg_pool.close()
+            _pg_pool = None
+
 
 def init_db() -> None:
-    """Initialise the SQLite database.
+    """Initialise the database.
 
-    This function creates the `users` and `chat_history` tables if
-    they do not already exist.  It should be invoked exactly once at
-    application startup.
+    This function creates the `users` and `chat_history` tables and
+    the index used by `load_history` if they do not already exist.
+    `app.py` calls it at the top of every rerun, so only the first
+    call in a process touches the database; the schema statements take
+    table locks on PostgreSQL and would otherwise block chat writes
+    from other sessions.
     """
-    conn = sqlite3.connect(DB)
-    # Create a table for storing user credentials.  The password is
-    # stored as a SHA256 hash; see `app.py` for details on how it is
-    # generated.  The username is the primary key to prevent
-    # duplicates.
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS users(
-            username TEXT PRIMARY KEY,
-            password_hash TEXT
-        );
-        """
-    )
-    # Create a table for storing chat messages.  Each row records the
-    # message author (role), the domain (context), the content of the
-    # message and a timestamp.  The auto‑incrementing `id` column
-    # ensures messages are returned in order.
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS chat_history(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT,
-            domain TEXT,
-            role TEXT,
-            content TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        );
-        """
-    )
-    conn.commit()
-    conn.close()
+    global _initialised
+    if _initialised:
+        return
+    with _lock:
+        if _initialised:
+            return
+        _create_schema()
+        _initialised = True
+
+
+def _create_schema() -> None:
+    """Create the tables and indexes used by this module."""
+    with _connection() as conn:
+        # Create a table for storing user credentials.  The password is
+        # stored as a bcrypt hash; see `hash_password` for details on
+        # how it is generated.  The username is the primary key to
+        # prevent duplicates.
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users(
+                username TEXT PRIMARY KEY,
+                password_hash TEXT
+            );
+            """
+        )
+        # Create a table for storing chat messages.  Each row records the
+        # message author (role), the domain (context), the content of the
+        # message and a timestamp.  The auto‑incrementing `id` column
+        # ensures messages are returned in order.
+        if _POSTGRES:
+            id_column = "id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY"
+        else:
+            id_column = "id INTEGER PRIMARY KEY AUTOINCREMENT"
+        conn.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS chat_history(
+                {id_column},
+                username TEXT,
+                domain TEXT,
+                role TEXT,
+                content TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+        if _POSTGRES:
+            # PostgreSQL limits the size of B‑tree index entries, so
+            # the message content cannot be part of the index.  Index
+            # the lookup columns and add a full‑text index on the
+            # content for searching conversations.  Planner statistics
+            # are maintained by autovacuum.
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_chat_user_domain
+                ON chat_history(username, domain, id);
+                """
+            )
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_chat_content_fts
+                ON chat_history USING GIN (to_tsvector('simple', content));
+                """
+            )
+        else:
+            # `load_history` filters on username and domain and orders
+            # by id.  This index covers that query entirely (including
+            # the selected role and content columns), so it becomes a
+            # range scan over the index instead of a full table scan
+            # and sort.
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_chat_user_domain_cover
+                ON chat_history(username, domain, id, role, content);
+                """
+            )
+            # Refresh the query planner statistics.  This runs once per
+            # process; ``analysis_limit`` samples each index instead of
+            # scanning it in full, so startup stays fast as the chat
+            # history grows.
+            conn.execute("PRAGMA analysis_limit=1000")
+            conn.execute("ANALYZE")
+
+
+def hash_password(password: str) -> str:
+    """Return the salted bcrypt hash stored for ``password``.
+
+    ``streamlit_authenticator`` verifies logins with bcrypt, so the
+    stored hash can be handed to it unchanged.
+    """
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
 
 
-def add_user(username: str, pwd_hash: str) -> None:
+def add_user(username: str, pwd_hash: str) -> bool:
     """Insert a new user into the database.
 
     If the username already exists, this function does nothing.
 
     Args:
         username: The desired username.
-        pwd_hash: A SHA256 hash of the user's password.
+        pwd_hash: A hash of the user's password from `hash_password`.
+
+    Returns:
+        True if the user was added, False if the username is taken.
     """
-    conn = sqlite3.connect(DB)
-    conn.execute(
-        "INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)",
-        (username, pwd_hash),
-    )
-    conn.commit()
-    conn.close()
+    with _connection() as conn:
+        cur = conn.execute(
+            _SQL_INSERT_USER,
+            (username, pwd_hash),
+        )
+        added = cur.rowcount > 0
+    if added:
+        _cache_user(username, pwd_hash)
+    return added
+
+
+def upgrade_legacy_password(username: str, password: str) -> bool:
+    """Re‑hash a legacy SHA256 password with bcrypt.
+
+    Accounts created before passwords were hashed with bcrypt store an
+    unsalted SHA256 hex digest, which ``streamlit_authenticator``
+    cannot verify.  If ``username`` has such a hash and it matches
+    ``password``, it is replaced with `hash_password` of the same
+    password so the account can log in again.
+
+    Args:
+        username: The existing username.
+        password: The plain‑text password supplied by the user.
+
+    Returns:
+        True if the stored hash was upgraded, False otherwise.
+    """
+    with _connection() as conn:
+        row = conn.execute(_SQL_SELECT_USER_HASH, (username,)).fetchone()
+    if row is None or row[0] is None or row[0].startswith("$2"):
+        return False
+    legacy_hash = row[0]
+    if not hmac.compare_digest(
+        legacy_hash, hashlib.sha256(password.encode()).hexdigest()
+    ):
+        return False
+    pwd_hash = hash_password(password)
+    with _connection() as conn:
+        cur = conn.execute(_SQL_UPDATE_USER_HASH, (pwd_hash, username, legacy_hash))
+        upgraded = cur.rowcount > 0
+    if not upgraded:
+        return False
+    _cache_user(username, pwd_hash)
+    return True
+
+
+def _cache_user(username: str, pwd_hash: str) -> None:
+    """Record a new or changed password hash in the users cache."""
+    global _users_version
+    with _lock:
+        if _users_cache is not None:
+            _users_cache[username] = pwd_hash
+        _users_version += 1
 
 
 def save_msg(username: str, domain: str, role: str, content: str) -> None:
@@ -93,13 +362,34 @@ def save_msg(username: str, domain: str, role: str, content: str) -> None:
         role: Either "user" or "assistant".
         content: The message content.
     """
-    conn = sqlite3.connect(DB)
-    conn.execute(
-        "INSERT INTO chat_history(username, domain, role, content) VALUES (?, ?, ?, ?)",
-        (username, domain, role, content),
-    )
-    conn.commit()
-    conn.close()
+    with _connection() as conn:
+        conn.execute(
+            _SQL_INSERT_MSG,
+            (username, domain, role, content),
+        )
+
+
+def save_msgs(username: str, domain: str, rows) -> None:
+    """Persist several chat messages in a single transaction.
+
+    Args:
+        username: The user who owns this conversation.
+        domain: The selected domain (e.g. "იურისტი").
+        rows: An iterable of ``(role, content)`` pairs, in order.
+    """
+    params = [(username, domain, role, content) for role, content in rows]
+    with _connection() as conn:
+        if _POSTGRES:
+            with conn.transaction():
+                conn.cursor().executemany(_SQL_INSERT_MSG, params)
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(_SQL_INSERT_MSG, params)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
 
 
 def load_history(username: str, domain: str):
@@ -113,12 +403,11 @@ def load_history(username: str, domain: str):
         A list of dictionaries with keys "role" and "content", ordered
         by message ID ascending.
     """
-    conn = sqlite3.connect(DB)
-    rows = conn.execute(
-        "SELECT role, content FROM chat_history WHERE username = ? AND domain = ? ORDER BY id",
-        (username, domain),
-    ).fetchall()
-    conn.close()
+    with _connection() as conn:
+        rows = conn.execute(
+            _SQL_SELECT_HISTORY,
+            (username, domain),
+        ).fetchall()
     return [
         {"role": role, "content": content} for role, content in rows
     ]
@@ -127,7 +416,8 @@ def load_history(username: str, domain: str):
 def get_users():
     """Return all registered users and their password hashes.
 
-    This helper queries the ``users`` table and returns a list of
+    This helper serves the ``users`` table from an in‑memory cache that
+    is refreshed every ``USERS_CACHE_TTL`` seconds.  It returns a list of
     tuples containing the username and the corresponding password
     hash.  It is used by the application to build the
     ``credentials`` dictionary required by ``streamlit_authenticator``.
@@ -137,7 +427,31 @@ def get_users():
         pairs.  If there are no users in the database, the list will
         be empty.
     """
-    conn = sqlite3.connect(DB)
-    rows = conn.execute("SELECT username, password_hash FROM users").fetchall()
-    conn.close()
-    return rows
\ No newline at end of file
+    return list(_load_users().items())
+
+
+def _load_users():
+    """Return the cached ``{username: password_hash}`` mapping."""
+    global _users_cache, _users_loaded_at, _users_version
+    with _lock:
+        now = time.monotonic()
+        if _users_cache is None or now - _users_loaded_at > USERS_CACHE_TTL:
+            with _connection() as conn:
+                users = dict(conn.execute(_SQL_SELECT_USERS).fetchall())
+            if _users_cache is not None and users != _users_cache:
+                _users_version += 1
+            _users_cache = users
+            _users_loaded_at = now
+        return _users_cache
+
+
+def users_version() -> int:
+    """Return a counter that changes whenever the set of users changes.
+
+    Callers can store the value alongside data derived from
+    `get_users` and rebuild it only when the counter moves on.  The
+    users cache is refreshed first if it has expired, so registrations
+    made by other processes are picked up.
+    """
+    _load_users()
+    return _users_version
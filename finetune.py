@@ -10,14 +10,29 @@ history for the current user and domain, writes it to a JSONL
 dataset and then performs LoRA fine‑tuning.  The resulting adapter
 is saved in the `lora_model` directory.
 
-Set the environment variables `CURRENT_USER` and `CURRENT_DOMAIN`
-before invoking this script so that it can retrieve the appropriate
-conversation from the database.
+`app.py` imports this module and calls `main(user=..., domain=...)`
+directly.  When run as a script, set the environment variables
+`CURRENT_USER` and `CURRENT_DOMAIN` instead so that it can retrieve
+the appropriate conversation from the database.  Setting `AUGMENT_DATASET=1` also
+asks OpenAI to paraphrase every question before training; those
+requests are issued concurrently and throttled to stay within the
+account's rate limits.
 """
 
+import asyncio
+import logging
+import math
 import os
-import json
-from typing import List, Dict
+import time
+from typing import List, Dict, Optional
+
+import orjson
+from openai import (
+    APIConnectionError,
+    AsyncOpenAI,
+    InternalServerError,
+    RateLimitError,
+)
 
 from unsloth import FastLanguageModel, is_bfloat16_supported
 import torch
@@ -26,7 +41,194 @@ from trl import SFTTrainer
 
 from auth_db import load_history
 
-def build_dataset_from_history(history: List[Dict[str, str]], domain: str, output_file: str) -> None:
+logger = logging.getLogger(__name__)
+
+class _RateLimiter:
+    """Token‑bucket limiter for requests and tokens per minute.
+
+    Both buckets refill continuously.  `acquire` waits until there is
+    capacity for one more request consuming ``tokens`` tokens.  A
+    request estimated at more than the per‑minute token limit is
+    charged the full limit, since the bucket can never hold more.
+    """
+
+    def __init__(self, max_requests_per_minute: float, max_tokens_per_minute: float) -> None:
+        self.max_requests = max_requests_per_minute
+        self.max_tokens = max_tokens_per_minute
+        self.requests = max_requests_per_minute
+        self.tokens = max_tokens_per_minute
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int) -> None:
+        tokens = min(tokens, self.max_tokens)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                elapsed = now - self.last
+                self.last = now
+                self.requests = min(
+                    self.max_requests, self.requests + elapsed * self.max_requests / 60
+                )
+                self.tokens = min(
+                    self.max_tokens, self.tokens + elapsed * self.max_tokens / 60
+                )
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep(0.05)
+
+
+# Errors worth retrying: rate limits, network failures and timeouts
+# (``APITimeoutError`` is a subclass of ``APIConnectionError``) and 5xx
+# server errors.  Anything else, such as a bad request or an invalid
+# API key, fails immediately.
+_RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+
+def _retry_delay(exc: Exception, attempt: int) -> float:
+    """Return how long to wait before retrying after ``exc``.
+
+    Honours the server's ``Retry-After`` header when present and falls
+    back to exponential backoff otherwise.
+    """
+    response = getattr(exc, "response", None)
+    if response is not None:
+        try:
+            return float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    return 2 ** attempt
+
+
+async def _call(
+    client: AsyncOpenAI,
+    prompt: str,
+    semaphore: asyncio.Semaphore,
+    limiter: _RateLimiter,
+    model: str,
+    max_tokens: int,
+    max_attempts: int,
+) -> str:
+    """Send one chat completion request, retrying transient failures."""
+    # Rough token estimate used for throttling: ~4 characters per token
+    # for the prompt plus the maximum completion length.
+    tokens = len(prompt) // 4 + max_tokens
+    async with semaphore:
+        for attempt in range(max_attempts):
+            await limiter.acquire(tokens)
+            try:
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=[{"role": "user", "content": prompt}],
+                    max_tokens=max_tokens,
+                )
+                return response.choices[0].message.content
+            except _RETRYABLE_ERRORS as exc:
+                if attempt == max_attempts - 1:
+                    raise
+                await asyncio.sleep(_retry_delay(exc, attempt))
+
+
+async def _call_all(
+    prompts: List[str],
+    model: str,
+    max_concurrent: int,
+    max_requests_per_minute: float,
+    max_tokens_per_minute: float,
+    max_tokens: int,
+    max_attempts: int,
+) -> List[str]:
+    client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    semaphore = asyncio.Semaphore(max_concurrent)
+    limiter = _RateLimiter(max_requests_per_minute, max_tokens_per_minute)
+    try:
+        return await asyncio.gather(
+            *[
+                _call(client, p, semaphore, limiter, model, max_tokens, max_attempts)
+                for p in prompts
+            ],
+            return_exceptions=True,
+        )
+    finally:
+        await client.close()
+
+
+def augment_records(
+    records: List[Dict[str, str]],
+    questions: List[str],
+    domain: str,
+    model: str = "gpt-4o-mini",
+    max_concurrent: int = 10,
+    max_requests_per_minute: float = 500,
+    max_tokens_per_minute: float = 200_000,
+    max_tokens: int = 512,
+    max_attempts: int = 5,
+) -> List[Dict[str, str]]:
+    """Paraphrase each question via OpenAI and return the extra records.
+
+    All requests are issued concurrently (bounded by
+    ``max_concurrent``) and throttled by a token bucket so that the
+    request and token rates stay within the given limits.  Rate‑limit,
+    connection and server errors are retried up to ``max_attempts``
+    times, waiting for the server's ``Retry-After`` or with exponential
+    backoff.  Questions that still fail are skipped and logged; if every
+    request fails, the first error is raised instead so that a bad API
+    key or model name does not silently disable augmentation.
+
+    Args:
+        records: The ``prompt``/``completion`` records built from the
+                 chat history.
+        questions: The original user question for each record.
+        domain: The domain context used to build the new prompts.
+
+    Returns:
+        A list of new records pairing each paraphrased question with
+        the original completion.
+    """
+    prompts = [
+        "გადაწერე ეს კითხვა სხვა სიტყვებით, აზრის შეცვლის გარეშე. "
+        f"დააბრუნე მხოლოდ კითხვა.\n{question}"
+        for question in questions
+    ]
+    replies = asyncio.run(
+        _call_all(
+            prompts,
+            model,
+            max_concurrent,
+            max_requests_per_minute,
+            max_tokens_per_minute,
+            max_tokens,
+            max_attempts,
+        )
+    )
+    errors = [reply for reply in replies if isinstance(reply, BaseException)]
+    if errors and len(errors) == len(replies):
+        raise errors[0]
+    if errors:
+        logger.warning(
+            "Augmentation failed for %d of %d questions: %r",
+            len(errors),
+            len(replies),
+            errors[0],
+        )
+    return [
+        {
+            "prompt": f"შექმენი {domain} პასუხი.\n{reply.strip()}",
+            "completion": record["completion"],
+        }
+        for reply, record in zip(replies, records)
+        if not isinstance(reply, BaseException) and reply
+    ]
+
+
+def build_dataset_from_history(
+    history: List[Dict[str, str]],
+    domain: str,
+    output_file: str,
+    augment: bool = False,
+) -> None:
     """Create a JSONL dataset from the user's chat history.
 
     This helper function iterates over the chat history in pairs of
@@ -40,45 +242,93 @@ def build_dataset_from_history(history: List[Dict[str, str]], domain: str, outpu
         domain: The domain context (e.g. "იურისტი") used to augment
                 the prompt.
         output_file: Path to the JSONL file to create.
+        augment: If true, add a paraphrased copy of every question
+                 generated with `augment_records`.
     """
-    with open(output_file, "w", encoding="utf-8") as f:
-        for i in range(0, len(history), 2):
-            if i + 1 < len(history):
-                prompt = f"შექმენი {domain} პასუხი.\n{history[i]['content']}"
-                completion = history[i + 1]["content"]
-                record = {"prompt": prompt, "completion": completion}
-                f.write(json.dumps(record, ensure_ascii=False) + "\n")
-
-
-def main() -> None:
-    """Entry point for the fine‑tuning script."""
-    # Retrieve the user and domain from environment variables.  If
-    # these variables are not set, raise an informative error.
-    user = os.getenv("CURRENT_USER")
-    domain = os.getenv("CURRENT_DOMAIN")
-    if not user or not domain:
-        raise RuntimeError(
-            "CURRENT_USER and CURRENT_DOMAIN environment variables must be set"
-        )
-    # Load chat history from the database
-    history = load_history(user, domain)
-    if not history:
-        raise RuntimeError("No chat history found for the specified user and domain")
-    # Build the training dataset
-    dataset_path = "dataset.jsonl"
-    build_dataset_from_history(history, domain, dataset_path)
+    # User turns sit at even indices and the assistant replies at odd
+    # ones; ``zip`` drops a trailing question that has no reply yet.
+    user_turns = history[0::2]
+    assistant_turns = history[1::2]
+    questions = [u["content"] for u, _ in zip(user_turns, assistant_turns)]
+    records = [
+        {"prompt": f"შექმენი {domain} პასუხი.\n{u['content']}", "completion": a["content"]}
+        for u, a in zip(user_turns, assistant_turns)
+    ]
+    if augment:
+        records += augment_records(records, questions, domain)
+    # orjson emits UTF‑8 bytes directly (non‑ASCII text is not
+    # escaped), so the whole file can be written in one call.
+    with open(output_file, "wb") as f:
+        f.write(b"".join(orjson.dumps(record) + b"\n" for record in records))
 
-    # Maximum sequence length for the model
-    max_seq_length = 2048
-    # Load a 4‑bit quantised Meta‑Llama model
-    model, tokenizer = FastLanguageModel.from_pretrained(
-        model_name="unsloth/Meta-Llama-3.1-8B-Instruct-bnb-4bit",
-        max_seq_length=max_seq_length,
-        load_in_4bit=True,
-    )
+
+# Maximum sequence length for the model
+MAX_SEQ_LENGTH = 2048
+
+# Packing only emits full ``MAX_SEQ_LENGTH`` chunks and drops the tail,
+# so it is only enabled once the formatted dataset fills several
+# sequences.  Smaller histories (a handful of Q/A pairs) train
+# unpacked.
+PACKING_MIN_TOKENS = 4 * MAX_SEQ_LENGTH
+
+# Optimiser steps for an unpacked run with an effective batch of 8.
+MAX_STEPS = 60
+
+# Dataset preprocessing only forks worker processes for large datasets,
+# and never more than ``MAX_NUM_PROC``.  `app.py` runs training inside
+# the multi‑threaded Streamlit server, which also holds a CUDA context;
+# forking that process per CPU for a few rows costs more than it saves
+# and risks fork‑after‑threads deadlocks.
+PARALLEL_MIN_ROWS = 1000
+MAX_NUM_PROC = 4
+
+
+def _num_proc(num_rows: int) -> Optional[int]:
+    """Return the number of preprocessing processes for ``num_rows``."""
+    if num_rows < PARALLEL_MIN_ROWS:
+        return None
+    return min(MAX_NUM_PROC, os.cpu_count() or 1)
+
+# The base model and tokenizer are loaded once per process and reused
+# by every fine‑tuning job, since `app.py` keeps this module imported.
+_MODEL = None
+_TOKENIZER = None
+
+
+def reset_adapters(model):
+    """Remove LoRA adapters left over from a previous run.
+
+    `FastLanguageModel.get_peft_model` injects the adapter layers into
+    the base model in place, so they must be unloaded before fresh
+    adapters can be attached.  Models without adapters are returned
+    unchanged.
+    """
+    if hasattr(model, "peft_config"):
+        return model.unload()
+    return model
+
+
+def get_lora_model():
+    """Return the model with freshly initialised LoRA adapters.
+
+    The 4‑bit base model is only loaded from disk on the first call;
+    later calls strip the previous adapters with `reset_adapters` and
+    attach new ones to the weights already in GPU memory.
+
+    Returns:
+        A ``(model, tokenizer)`` tuple.
+    """
+    global _MODEL, _TOKENIZER
+    if _MODEL is None:
+        # Load a 4‑bit quantised Meta‑Llama model
+        _MODEL, _TOKENIZER = FastLanguageModel.from_pretrained(
+            model_name="unsloth/Meta-Llama-3.1-8B-Instruct-bnb-4bit",
+            max_seq_length=MAX_SEQ_LENGTH,
+            load_in_4bit=True,
+        )
     # Prepare the model for LoRA fine‑tuning
-    model = FastLanguageModel.get_peft_model(
-        model,
+    _MODEL = FastLanguageModel.get_peft_model(
+        reset_adapters(_MODEL),
         r=64,
         target_modules=[
             "q_proj",
@@ -96,24 +346,78 @@ def main() -> None:
         random_state=3407,
         use_rslora=False,
     )
+    return _MODEL, _TOKENIZER
+
+
+def main(user: Optional[str] = None, domain: Optional[str] = None) -> None:
+    """Entry point for the fine‑tuning script.
+
+    Args:
+        user: The user whose chat history to train on.  Defaults to
+              the `CURRENT_USER` environment variable.
+        domain: The domain to train on.  Defaults to the
+                `CURRENT_DOMAIN` environment variable.
+    """
+    # Fall back to environment variables when the user and domain are
+    # not passed in.  If neither is available, raise an informative
+    # error.
+    user = user or os.getenv("CURRENT_USER")
+    domain = domain or os.getenv("CURRENT_DOMAIN")
+    if not user or not domain:
+        raise RuntimeError(
+            "CURRENT_USER and CURRENT_DOMAIN environment variables must be set"
+        )
+    # Load chat history from the database
+    history = load_history(user, domain)
+    if not history:
+        raise RuntimeError("No chat history found for the specified user and domain")
+    # Build the training dataset
+    dataset_path = "dataset.jsonl"
+    augment = os.getenv("AUGMENT_DATASET") == "1"
+    build_dataset_from_history(history, domain, dataset_path, augment=augment)
+
+    # Maximum sequence length for the model
+    max_seq_length = MAX_SEQ_LENGTH
+    # Reuse the already loaded base model with fresh LoRA adapters
+    model, tokenizer = get_lora_model()
     # Load the dataset from the generated JSONL
     dataset = load_dataset("json", data_files=dataset_path, split="train")
     # Get chat template and formatting function
     tokenizer = FastLanguageModel.get_chat_template(tokenizer)
     def formatting_prompts_func(examples):
-        texts = []
-        for prompt, completion in zip(examples["prompt"], examples["completion"]):
-            text = tokenizer.apply_chat_template(
-                [
-                    {"role": "user", "content": prompt},
-                    {"role": "assistant", "content": completion},
-                ],
-                tokenize=False,
-            )
-            texts.append(text)
+        # Render the whole batch with a single call; the tokenizer
+        # accepts a list of conversations and returns a list of texts.
+        conversations = [
+            [
+                {"role": "user", "content": prompt},
+                {"role": "assistant", "content": completion},
+            ]
+            for prompt, completion in zip(examples["prompt"], examples["completion"])
+        ]
+        texts = tokenizer.apply_chat_template(conversations, tokenize=False)
         return {"text": texts}
     # Apply formatting to the dataset
-    dataset = dataset.map(formatting_prompts_func, batched=True)
+    dataset = dataset.map(
+        formatting_prompts_func, batched=True, num_proc=_num_proc(len(dataset))
+    )
+    # Decide whether to pack.  Packing concatenates the short Q/A pairs
+    # into full ``max_seq_length`` sequences instead of padding every
+    # example, but needs enough text to fill several of them.
+    total_tokens = sum(
+        len(ids)
+        for ids in tokenizer(dataset["text"], add_special_tokens=False)["input_ids"]
+    )
+    packing = total_tokens >= PACKING_MIN_TOKENS
+    if packing:
+        # Packing turns the dataset into fewer, longer examples.  Scale
+        # the step count so that training still makes the same number
+        # of passes over the data as the unpacked configuration.
+        packed_examples = total_tokens // max_seq_length
+        batch_size, accumulation_steps = 8, 1
+        max_steps = max(1, math.ceil(MAX_STEPS * packed_examples / len(dataset)))
+    else:
+        batch_size, accumulation_steps = 2, 4
+        max_steps = MAX_STEPS
     # Configure the SFT trainer
     trainer = SFTTrainer(
         model=model,
@@ -121,13 +425,15 @@ def main() -> None:
         train_dataset=dataset,
         dataset_text_field="text",
         max_seq_length=max_seq_length,
-        dataset_num_proc=2,
-        packing=False,
+        dataset_num_proc=_num_proc(len(dataset)),
+        packing=packing,
         args=dict(
-            per_device_train_batch_size=2,
-            gradient_accumulation_steps=4,
-            warmup_steps=5,
-            max_steps=60,
+            per_device_train_batch_size=batch_size,
+            gradient_accumulation_steps=accumulation_steps,
+            # Keep the warmup short relative to the (possibly much
+            # shorter) packed run.
+            warmup_steps=min(5, max_steps // 10),
+            max_steps=max_steps,
             learning_rate=2e-4,
             fp16=not is_bfloat16_supported(),
             bf16=is_bfloat16_supported(),